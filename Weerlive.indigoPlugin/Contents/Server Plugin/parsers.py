@@ -0,0 +1,275 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Request and parse functions for the Weerlive plugin. These do not use Indigo, so they
+#   run both inside the plugin and in the (optional) worker process, see worker.py
+#
+#   Every parse function takes the response text (plus the job's args, if any) and returns
+#   plain lists, dicts and numbers (so the result can be sent over a pipe), or raises
+#   ValueError with a reason
+#
+#########################################################################################
+
+import datetime
+import hashlib
+import json
+import math
+import requests
+
+
+# Weerlive fields that are taken as-is from the nearest Buienradar station measurement
+BUIENRADARFIELDS = [('plaats', 'regio'), ('temp', 'temperature'), ('gtemp', 'feeltemperature'),
+                    ('samenv', 'weatherdescription'), ('lv', 'humidity'), ('windr', 'winddirection'),
+                    ('windrgr', 'winddirectiondegrees'), ('windms', 'windspeed'), ('winds', 'windspeedBft'),
+                    ('windbft', 'windspeedBft'), ('luchtd', 'airpressure')]
+
+# Weerlive day forecast fields (d0.., d1.., d2..) from the Buienradar five day forecast
+BUIENRADARDAYFIELDS = [('tmax', 'maxtemperatureMax'), ('tmin', 'mintemperatureMin'), ('windk', 'wind'),
+                       ('neerslag', 'rainChance'), ('zon', 'sunChance')]
+
+
+def weerlive(text):
+   ##########################################################################################
+   # Weerlive json: the list of 'liveweer' dicts
+   ##########################################################################################
+   try:
+      rj = json.loads(text)
+   except ValueError:
+      raise ValueError("could not decode the response into JSON")
+   if "liveweer" not in rj:
+      raise ValueError("result did not contain the expected 'liveweer' info")
+   return rj['liveweer']
+
+
+def raintext(text):
+   ##########################################################################################
+   # Buienradar raintext: lines of "rainfall|HH:MM" in 5 minute periods
+   ##########################################################################################
+   moment = datetime.datetime.now()
+
+   # The rain next 10 minutes is 2 iterations, next hour is 12, next 2 hours is all
+   sum10  = 0.0
+   sum60  = 0.0
+   sum120 = 0.0
+   fstr = ""
+   raintext = ""
+   forecast = []   # (minutes ahead, mm/hr) for the plugin events
+
+   hr = moment.hour
+   hrBefore = moment.hour
+   minBefore = moment.minute
+
+   itercount = 0
+   for l in text.splitlines():
+      itercount += 1
+      try:
+         rainfall , raintime  = l.split("|")
+      except ValueError:
+         raise ValueError("unexpected raintext line '{}'".format(l))
+      raintime = raintime.strip()
+      rainfall = rainfall.strip()
+      raintext += rainfall + ";"
+
+      if len(raintime) > 4 and raintime[0:2].isnumeric() and raintime[3:].isnumeric():
+         hrBefore = int(raintime[0:2])
+         minBefore = int(raintime[3:])
+
+         if hrBefore < hr:
+            # day change
+            moment = moment + datetime.timedelta(days=1)
+      nt = moment.replace(hour=hrBefore, minute=minBefore)
+      hr = hrBefore
+
+      # Thanks to https://github.com/mjj4791/python-buienradar/pull/13
+      intensiteit = (10 ** ((float(rainfall.replace(',', '.')) - 109.0) / 32.0)) / 12.0 # Divide by 12 since it is a 5 minute period
+
+      # Add to running total
+      if itercount < 3:
+         sum10 += intensiteit
+      if itercount < 13:
+         sum60 += intensiteit
+      sum120 += intensiteit
+      forecast.append(((itercount - 1) * 5, intensiteit * 12.0))
+
+      # And to plot input file in memory
+      fstr += "{},{}\n".format(nt,str(round(intensiteit,2)))
+
+   return {'sum10'    : round(sum10,3),
+           'sum60'    : round(sum60,3),
+           'sum120'   : round(sum120,3),
+           'raintext' : raintext,
+           'forecast' : forecast,
+           'csv'      : fstr}
+
+
+def utcToLocal(ts):
+   ##########################################################################################
+   # OpenUV utc time string to local time; raises ValueError if it is not a valid time
+   ##########################################################################################
+   dt = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%fZ')
+   # local system time zone of the OS, without tzinfo like the other times in the plugin
+   return dt.replace(tzinfo = datetime.timezone.utc).astimezone().replace(tzinfo = None)
+
+
+def localTime(container, name):
+   ##########################################################################################
+   # Local time string of an optional OpenUV utc time field, or "" if absent or not valid
+   ##########################################################################################
+   try:
+      return utcToLocal(container[name]).strftime("%Y-%m-%d %H:%M")
+   except (KeyError, TypeError, ValueError):
+      return ""
+
+
+def openuvresult(text, kind):
+   ##########################################################################################
+   # OpenUV json: the 'result' part, which must be of the given kind (dict or list)
+   ##########################################################################################
+   try:
+      rj = json.loads(text)
+   except ValueError:
+      raise ValueError("could not decode the response into JSON")
+   if not isinstance(rj, dict) or not isinstance(rj.get('result'), kind):
+      raise ValueError("result did not contain the expected 'result' info")
+   return rj['result']
+
+
+def openuv(text):
+   ##########################################################################################
+   # OpenUV actual: the current UV index (uv, with its local time as isoformat), the max of
+   # today, ozone, safe exposure minutes per skin type and local sun times. Fields OpenUV
+   # did not send are left out
+   ##########################################################################################
+   res = openuvresult(text, dict)
+   m = {}
+   if res.get('uv_time') and res.get('uv') is not None:
+      m['time'] = utcToLocal(res['uv_time']).isoformat()
+      m['uv'] = float(res['uv'])
+   if res.get('uv_max') is not None:
+      m['uvmax'] = round(float(res['uv_max']), 2)
+   if res.get('ozone') is not None and 'ozone_time' in res:
+      m['ozone'] = float(res['ozone'])
+      m['ozonetime'] = localTime(res, 'ozone_time')
+
+   se = res.get('safe_exposure_time') or {}
+   m['safe'] = dict((st, se[st]) for st in ['st{}'.format(x) for x in range(1, 7)] if se.get(st) is not None)
+
+   st = (res.get('sun_info') or {}).get('sun_times')
+   if isinstance(st, dict):
+      m['sun'] = dict((name, localTime(st, name)) for name in ['sunriseEnd', 'sunsetStart', 'solarNoon', 'night'])
+   return m
+
+
+def openuvforecast(text):
+   ##########################################################################################
+   # OpenUV forecast: a sorted list of [local time as isoformat, uv index] points
+   ##########################################################################################
+   points = [(utcToLocal(fc['uv_time']), round(float(fc['uv']), 2)) for fc in openuvresult(text, list)]
+   return [[t.isoformat(), uv] for t, uv in sorted(points)]
+
+
+def dewpoint(temp, humidity):
+   ##########################################################################################
+   # Dew point from temperature and relative humidity (Magnus formula)
+   ##########################################################################################
+   gamma = math.log(humidity / 100.0) + 17.62 * temp / (243.12 + temp)
+   return round(243.12 * gamma / (17.62 - gamma), 1)
+
+
+def buienradarjson(text, lat, lon):
+   ##########################################################################################
+   # Buienradar json feed, mapped onto the weerlive fields so it can stand in for weerlive:
+   # a list with one 'liveweer' like dict for the station closest to lat, lon. Fields that
+   # Buienradar does not have (like image and alarm) are left out
+   ##########################################################################################
+   try:
+      rj = json.loads(text)
+   except ValueError:
+      raise ValueError("could not decode the response into JSON")
+   try:
+      actual = rj['actual']
+      stations = [st for st in actual['stationmeasurements'] if st.get('temperature') is not None]
+   except (KeyError, TypeError):
+      raise ValueError("result did not contain the expected 'actual' info")
+   if len(stations) == 0:
+      raise ValueError("result did not contain any station measurements")
+
+   st = min(stations, key = lambda st: (float(st['lat']) - lat) ** 2 + (float(st['lon']) - lon) ** 2)
+   m = dict((field, st[name]) for field, name in BUIENRADARFIELDS if st.get(name) is not None)
+
+   if st.get('windspeed') is not None:
+      m['windkmh'] = round(float(st['windspeed']) * 3.6, 1)
+      m['windk'] = m['windknp'] = round(float(st['windspeed']) * 1.943844, 1)
+   if st.get('airpressure') is not None:
+      m['ldmmhg'] = int(round(float(st['airpressure']) * 0.750062))
+   if st.get('visibility') is not None:
+      m['zicht'] = round(float(st['visibility']) / 1000.0, 1)
+   if st.get('humidity'):
+      m['dauwp'] = dewpoint(float(st['temperature']), float(st['humidity']))
+
+   for field, name in [('sup', 'sunrise'), ('sunder', 'sunset')]:
+      if actual.get(name):
+         m[field] = actual[name][11:16]
+
+   forecast = rj.get('forecast') or {}
+   if (forecast.get('shortterm') or {}).get('forecast'):
+      m['verw'] = forecast['shortterm']['forecast']
+
+   today = datetime.date.today()
+   for day in forecast.get('fivedayforecast') or []:
+      try:
+         offset = (datetime.datetime.strptime(day['day'][0:10], '%Y-%m-%d').date() - today).days
+      except (KeyError, TypeError, ValueError):
+         continue
+      if 0 <= offset <= 2:
+         for field, name in BUIENRADARDAYFIELDS:
+            if day.get(name) is not None:
+               m['d{}{}'.format(offset, field)] = day[name]
+         if day.get('windDirection'):
+            m['d{}windr'.format(offset)] = day['windDirection'].upper()
+   return [m]
+
+
+PARSERS = {'weerlive' : weerlive, 'raintext' : raintext, 'openuv' : openuv, 'openuvforecast' : openuvforecast,
+           'buienradarjson' : buienradarjson}
+
+
+def get(job):
+   ##########################################################################################
+   # Run one request job: {url, params, headers, parser, args, hash}. The reply holds the
+   # status, the validators, a hash of the body and the parsed data. Parsing is skipped when
+   # the body hash equals the job's hash (nothing changed since the last time)
+   ##########################################################################################
+   reply = {'status' : None, 'etag' : None, 'modified' : None, 'digest' : None,
+            'data' : None, 'error' : None, 'text' : None}
+   try:
+      r = requests.get(url = job['url'], params = job.get('params'), headers = job.get('headers'),
+                       timeout=30, verify=False)
+   except requests.exceptions.RequestException as e:
+      reply['error'] = str(e)
+      return reply
+
+   reply['status'] = r.status_code
+   reply['etag'] = r.headers.get('ETag')
+   reply['modified'] = r.headers.get('Last-Modified')
+   if r.status_code == 304:
+      return reply
+   if not r.ok:
+      reply['text'] = r.text
+      return reply
+
+   reply['digest'] = hashlib.sha1(r.content).hexdigest()
+   if reply['digest'] == job.get('hash'):
+      return reply
+
+   try:
+      reply['data'] = PARSERS[job['parser']](r.text, *job.get('args', []))
+   except ValueError as e:
+      reply['error'] = str(e)
+      reply['text'] = r.text
+   except Exception as e:
+      # anything else means the payload did not have the layout the parser expects
+      reply['error'] = "result did not have the expected layout ({}: {})".format(type(e).__name__, e)
+      reply['text'] = r.text
+   return reply
@@ -54,8 +54,14 @@ try:
    import datetime
    import math
    import decimal
-   import requests
+   import hashlib
+   import collections
+   import json
+   import os
+   import time
    import xml.dom.minidom
+   import parsers
+   import worker
    libsOk = True
    dec = decimal.Decimal
 
@@ -63,6 +69,122 @@ except ImportError:
    libsOk = False
 
 
+class KeyPool(object):
+##########################################################################################
+#   Pool of API keys for one provider. Calls are counted per key per day; a key that is
+#   refused (401/403/429) is left out until the next day
+##########################################################################################
+
+   def __init__(self, keys, dailyMax, param = None, header = None):
+      self.keys     = keys
+      self.dailyMax = dailyMax
+      self.param    = param       # send the key as this url parameter
+      self.header   = header      # or as this request header
+      self.day      = datetime.date.today()
+      self.used     = dict((key, 0) for key in keys)
+      self.blocked  = set()
+
+   def label(self, key):
+      # Short reference to a key for logging and the snapshot, without storing the key
+      return hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]
+
+   def rollover(self):
+      if self.day != datetime.date.today():
+         self.day = datetime.date.today()
+         self.used = dict((key, 0) for key in self.keys)
+         self.blocked = set()
+
+   def capacity(self):
+      return self.dailyMax * max(len(self.keys), 1)
+
+   def pick(self):
+      # Key with the most calls left today, or None if all are used up or refused
+      self.rollover()
+      left = [(self.dailyMax - self.used[key], key) for key in self.keys if key not in self.blocked]
+      left = [(n, key) for n, key in left if n > 0]
+      return max(left)[1] if left else None
+
+   def count(self, key):
+      self.used[key] = self.used.get(key, 0) + 1
+
+   def block(self, key):
+      self.blocked.add(key)
+
+   def state(self):
+      return {'day'     : self.day.isoformat(),
+              'used'    : dict((self.label(key), n) for key, n in self.used.items()),
+              'blocked' : [self.label(key) for key in self.blocked]}
+
+   def restore(self, state):
+      if state.get('day') != datetime.date.today().isoformat():
+         return
+      for key in self.keys:
+         self.used[key] = state.get('used', {}).get(self.label(key), 0)
+         if self.label(key) in state.get('blocked', []):
+            self.blocked.add(key)
+
+
+class Provider(object):
+##########################################################################################
+#   A source for the weerlive device states, with its health. A provider that fails is
+#   left out for a while (longer after each failure in a row). The healthy provider with
+#   the best preference is used, so a fallback is only used while the primary is down and
+#   failback happens when its cool-down ends. Providers with the same preference are
+#   ranked by their response time
+##########################################################################################
+
+   def __init__(self, name, parser, preference, url = None, pool = None, located = False, clears = None):
+      self.name       = name
+      self.parser     = parser          # parser in parsers.py
+      self.preference = preference      # lower is preferred
+      self.url        = url             # None: use the request url of the device record
+      self.pool       = pool            # name of the key pool, if keys are needed
+      self.located    = located         # parser needs the device lattitude and longitude
+      self.clears     = clears or []    # device states this provider has no data for
+      self.latency    = None            # moving average of the response time in seconds
+      self.failures   = 0
+      self.downUntil  = datetime.datetime.min
+
+   def healthy(self, moment):
+      return moment >= self.downUntil
+
+   def rank(self):
+      # a provider without measurements yet counts as 1 second
+      return (self.preference, self.latency if self.latency is not None else 1.0)
+
+   def success(self, elapsed):
+      self.latency = elapsed if self.latency is None else 0.7 * self.latency + 0.3 * elapsed
+      self.failures = 0
+      self.downUntil = datetime.datetime.min
+
+   def failure(self, moment):
+      self.failures += 1
+      self.downUntil = moment + datetime.timedelta(minutes = min(2 ** self.failures, 60))
+
+   def reset(self):
+      # config changed (e.g. new api keys); try the provider again
+      self.failures = 0
+      self.downUntil = datetime.datetime.min
+
+
+class DeviceRecord(object):
+##########################################################################################
+#   Compact per device record with everything the poll loop needs, built once when the
+#   device starts or its config (or the plugin config) changes
+##########################################################################################
+   __slots__ = ('devId', 'name', 'typeId', 'lat', 'lon', 'url', 'headers', 'interval')
+
+   def __init__(self, dev):
+      self.devId    = dev.id
+      self.name     = dev.name
+      self.typeId   = dev.deviceTypeId
+      self.lat      = None
+      self.lon      = None
+      self.url      = None
+      self.headers  = None
+      self.interval = None
+
+
 class Plugin(indigo.PluginBase):
 ##########################################################################################
 #   Our Plugin Class
@@ -81,6 +203,15 @@ class Plugin(indigo.PluginBase):
       self.urlRT   = "https://gpsgadget.buienradar.nl/data/raintext"
       self.urlUV   = "https://api.openuv.io/api/v1/uv"
       self.urlUVfc = "https://api.openuv.io/api/v1/forecast"
+      self.urlBRjson = "https://data.buienradar.nl/2.0/feed/json"
+
+      # Sources for the weerlive device; Buienradar fills the same states when weerlive fails.
+      # States it has no data for are cleared, so they do not keep showing old weerlive values
+      brClears = ['image', 'alarm', 'alarmtxt'] + ['d{}{}'.format(day, field) for day in range(3)
+                  for field in ['weer', 'windknp', 'windms', 'windkmh', 'windrgr']]
+      self.weerliveProviders = [Provider("Weerlive", "weerlive", 1.0, pool = 'weerlive'),
+                                Provider("BuienradarFeed", "buienradarjson", 3.0, url = self.urlBRjson, located = True,
+                                         clears = brClears)]
 
       self.nxtWeerlive = datetime.datetime.min    # set next schedule moment for this device type
       self.nxtBuienradar = datetime.datetime.min 
@@ -88,6 +219,36 @@ class Plugin(indigo.PluginBase):
       self.nxtMoon = datetime.datetime.min
       self.nxtuvforecast = datetime.datetime.min
 
+      # Schedule moments saved in the warm restart snapshot, in the order overdue ones are
+      # staggered after a restart (free local calculations first, quota limited APIs last)
+      self.SCHEDULE = ['nxtMoon', 'nxtBuienradar', 'nxtWeerlive', 'nxtUV', 'nxtuvforecast']
+      self.STAGGER = datetime.timedelta(minutes = 1)
+
+      # Per device cache of the last payload (ETag, Last-Modified and content hash) so
+      # unchanged responses can be skipped without parsing or writing states
+      self.fetchCache = {}
+      self.metrics = {}
+
+      # Registry of started devices (devId -> DeviceRecord) and the resolved plugin prefs.
+      # Workers replaced by a config change are stopped by the poll thread, which may still
+      # be using them
+      self.registry = {}
+      self.retiredWorkers = []
+      self.loadPrefs(pluginPrefs)
+
+      # Plugin events being processed (triggerId -> trigger) and their last evaluated state
+      self.triggers = {}
+      self.triggerState = {}
+
+      # Derived UV metrics: latest forecast per uvfc device, live readings and the fine
+      # grained UV curve per uv device (ring buffers of one day in UVSTEP minute slots)
+      self.uvForecast = {}
+      self.uvReadings = {}
+      self.uvCurve = {}
+      self.UVSTEP = 5
+      self.UVSLOTS = 24 * 60 // self.UVSTEP
+      # Minimal erythemal dose in J/m2 per Fitzpatrick skin type 1..6
+      self.MED = [200.0, 250.0, 350.0, 450.0, 600.0, 1000.0]
 
       self.mplid = "com.fogbert.indigoplugin.matplotlib"
 
@@ -118,10 +279,151 @@ class Plugin(indigo.PluginBase):
       #########################################################################################
       #   My own logger
       ##########################################################################################
-      loglevel = self.pluginPrefs.get("logLevel","Normal")
-      if loglevel == "Verbose":
+      if self.logLevel == "Verbose":
           self.logger.info(logtext)
 
+   def prefInterval(self, prefs, name, default):
+      ##########################################################################################
+      #   Return an interval pref in minutes, or the default if it is not (yet) usable
+      ##########################################################################################
+      try:
+         return int(prefs.get(name, default))
+      except (TypeError, ValueError):
+         return default
+
+   def loadPrefs(self, prefs):
+      ##########################################################################################
+      #   Resolve the plugin prefs once, so the poll loop does not need to read them again
+      ##########################################################################################
+      self.logLevel         = prefs.get("logLevel", "Normal")
+      self.weerliveMode     = prefs.get("WeerLiveMode", False)
+      self.weerliveFailover = prefs.get("WeerLiveFailover", True)
+      self.buienradarMode   = prefs.get("BuienradarMode", False)
+      self.uvMode           = prefs.get("UVindexMode", False)
+      self.uvforecastMode   = prefs.get("uvforecastMode", False)
+      self.moonMode         = prefs.get("MoonPhaseMode", False)
+      self.plotMode         = prefs.get("PlotMode", False)
+      self.uvDailyMax       = self.prefInterval(prefs, "UVindexDailyMax", 50)
+      self.moonLanguage     = prefs.get("MoonLanguage", "NL")
+      self.daysOfWeek       = prefs.get("DaysOfWeek", "").split(',')
+      self.weerliveInterval = datetime.timedelta(minutes = self.prefInterval(prefs, "WeerLiveInterval", 10))
+      self.buienradarInterval = datetime.timedelta(minutes = self.prefInterval(prefs, "BuienRadarInterval", 10))
+
+      # Key pools; usage of keys that are still configured is carried over
+      keys = lambda name: [key.strip() for key in prefs.get(name, "").split(',') if key.strip()]
+      pools = {'weerlive' : KeyPool(keys("ApiKey"), self.prefInterval(prefs, "WeerLiveDailyMax", 300), param = 'key'),
+               'openuv'   : KeyPool(keys("UVApiKey"), self.uvDailyMax, header = 'x-access-token')}
+      for name, pool in pools.items():
+         if name in getattr(self, 'keyPools', {}):
+            pool.restore(self.keyPools[name].state())
+      self.keyPools = pools
+
+      # Providers left out (e.g. until midnight for lack of keys) get a new chance
+      for provider in self.weerliveProviders:
+         provider.reset()
+
+      # Worker process; a running one is retired so it restarts with the new settings
+      if getattr(self, 'worker', None) is not None:
+         self.retiredWorkers.append(self.worker)
+      self.workerMode = prefs.get("WorkerMode", False)
+      self.worker = worker.Worker(prefs.get("WorkerPython", "/Library/Frameworks/Python.framework/Versions/Current/bin/python3"),
+                                  self.prefInterval(prefs, "WorkerMaxJobs", 100),
+                                  self.prefInterval(prefs, "WorkerMaxMemory", 200))
+
+   def stopRetiredWorkers(self):
+      ##########################################################################################
+      #   Stop the workers replaced by loadPrefs; only called from the poll thread (or at
+      #   shutdown), so none of them can be running a job
+      ##########################################################################################
+      while self.retiredWorkers:
+         self.retiredWorkers.pop().stop()
+
+   def buildRecord(self, dev):
+      ##########################################################################################
+      #   Validate the device config and prebuild its request url and headers
+      ##########################################################################################
+      rec = DeviceRecord(dev)
+      props = dev.ownerProps
+
+      if rec.typeId != "moon":
+         latKey, lonKey = ("fclat", "fclon") if rec.typeId == "uvfc" else ("lat", "lon")
+         try:
+            rec.lat = float(props[latKey])
+            rec.lon = float(props[lonKey])
+         except (KeyError, ValueError):
+            self.logger.error(u"Device {} has no valid lattitude/longitude; not polled".format(dev.name))
+            return None
+
+      if rec.typeId == "weerlive":
+         rec.url = "{}?locatie={},{}".format(self.urlWL, rec.lat, rec.lon)
+         rec.interval = self.weerliveInterval
+      elif rec.typeId == "buienradar":
+         rec.url = "{}?lat={}&lon={}".format(self.urlRT, rec.lat, rec.lon)
+         rec.interval = self.buienradarInterval
+      elif rec.typeId == "uv":
+         rec.url = "{}?lat={}&lng={}".format(self.urlUV, rec.lat, rec.lon)
+         rec.headers = {'content-type' : 'application/json'}
+         rec.interval = datetime.timedelta(minutes = 30)    # default when sun times are unknown
+      elif rec.typeId == "uvfc":
+         rec.url = "{}?lat={}&lng={}".format(self.urlUVfc, rec.lat, rec.lon)
+         rec.headers = {'content-type' : 'application/json'}
+         rec.interval = datetime.timedelta(days = 1)
+      elif rec.typeId == "moon":
+         rec.interval = datetime.timedelta(minutes = 60)
+      return rec
+
+   def registerDevice(self, dev):
+      ##########################################################################################
+      #   (Re)build the registry record for a device
+      ##########################################################################################
+      rec = self.buildRecord(dev)
+      if rec is None:
+         self.registry.pop(dev.id, None)
+      else:
+         self.registry[dev.id] = rec
+         self.verbose(u"Registered device {} ({})".format(dev.name, dev.deviceTypeId))
+
+   def deviceStartComm(self, dev):
+      ##########################################################################################
+      #   Device is enabled or the plugin started; add it to the registry
+      ##########################################################################################
+      self.registerDevice(dev)
+
+   def deviceStopComm(self, dev):
+      ##########################################################################################
+      #   Device is disabled or the plugin stops; remove it from the registry. Its caches are
+      #   kept, so they end up in the snapshot saved at shutdown
+      ##########################################################################################
+      self.registry.pop(dev.id, None)
+
+   def deviceDeleted(self, dev):
+      ##########################################################################################
+      #   Device is deleted; its caches are not needed anymore
+      ##########################################################################################
+      indigo.PluginBase.deviceDeleted(self, dev)
+      self.fetchCache.pop(dev.id, None)
+      self.uvForecast.pop(dev.id, None)
+      self.uvReadings.pop(dev.id, None)
+      self.uvCurve.pop(dev.id, None)
+
+   def deviceUpdated(self, origDev, newDev):
+      ##########################################################################################
+      #   Rebuild the record only if the device config changed, not on every state update
+      ##########################################################################################
+      indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+      if newDev.id in self.registry and (origDev.ownerProps != newDev.ownerProps or origDev.name != newDev.name):
+         self.registerDevice(newDev)
+
+   def closedPrefsConfigUi(self, valuesDict, userCancelled):
+      ##########################################################################################
+      #   Plugin config saved; resolve the prefs again and rebuild all records
+      ##########################################################################################
+      if userCancelled:
+         return
+      self.loadPrefs(valuesDict)
+      for devId in list(self.registry):
+         self.registerDevice(indigo.devices[devId])
+
    def actionControlUniversal(self, action, dev):
       ##########################################################################################
       #   General Action callback
@@ -144,6 +446,9 @@ class Plugin(indigo.PluginBase):
       self.logger.info("Starting %s Plugin; version %s" % (self.pluginDisplayName,self.pluginVersion))
       self.logger.info("For detailled logging, set level to Verbose in Plugin Config")
 
+      # Continue where we left off, instead of polling every provider at once
+      self.restoreSnapshot()
+
       # Check at startup if the device definition is changed
       for dev in indigo.devices.iter("self"):
          dev.stateListOrDisplayStateIdChanged()
@@ -154,6 +459,11 @@ class Plugin(indigo.PluginBase):
       #   Plugin is requested to shutdown
       ##########################################################################################
       self.verbose(u"Plugin shutdown requested.")
+      self.saveSnapshot()
+      self.stopRetiredWorkers()
+      self.worker.stop()
+      for name in sorted(self.metrics):
+         self.verbose(u"Metric {}: {}".format(name, self.metrics[name]))
 
    def validateDeviceConfigUi(self, valuesDict, typeId, devId):
       ##########################################################################################
@@ -183,6 +493,9 @@ class Plugin(indigo.PluginBase):
          if len(valuesDict["ApiKey"]) == 0:
             errorDict["ApiKey"] = "The ApiKey seems empty"
             return(False, valuesDict, errorDict)
+         if not valuesDict["WeerLiveDailyMax"].isnumeric() or int(valuesDict["WeerLiveDailyMax"]) < 1:
+            errorDict["WeerLiveDailyMax"] = "Daily request max should be a positive number" 
+            return(False, valuesDict, errorDict)
          if not valuesDict["WeerLiveInterval"].isnumeric():
             errorDict["WeerLiveInterval"] = "Interval should be numeric" 
             return(False, valuesDict, errorDict)
@@ -219,6 +532,15 @@ class Plugin(indigo.PluginBase):
             errorDict["PlotMode"] = "Plugin MatPlotLib not found, cannot enable plot function"
             return(False, valuesDict, errorDict)
 
+      if valuesDict["WorkerMode"]:
+         for field in ["WorkerMaxJobs", "WorkerMaxMemory"]:
+            if not valuesDict[field].isnumeric() or int(valuesDict[field]) < 1:
+               errorDict[field] = "Should be a positive number"
+               return(False, valuesDict, errorDict)
+         if not os.path.isfile(valuesDict["WorkerPython"]):
+            errorDict["WorkerPython"] = "Python not found at this location"
+            return(False, valuesDict, errorDict)
+
       dow = valuesDict["DaysOfWeek"].split(',')
       if len(dow) != 7:
          errorDict["DaysOfWeek"] = "Not all 7 days of the week are filled"
@@ -242,40 +564,364 @@ class Plugin(indigo.PluginBase):
       valuesDict["lat"], valuesDict["lon"] = indigo.server.getLatitudeAndLongitude()
       return (valuesDict, errorsDict)
 
-   def utcToLocal(self,ts):
+   def countMetric(self, name):
       ##########################################################################################
-      # Convert received utc time string to local time string
+      # Increment a named counter, shown in the log when verbose logging is on
       ##########################################################################################
-      dt = datetime.datetime.strptime(ts,'%Y-%m-%dT%H:%M:%S.%fZ')
-      tsv = (dt - datetime.datetime(1970, 1, 1)).total_seconds()
-      d = datetime.datetime.utcfromtimestamp(tsv) # get the UTC time from the timestamp integer value.
-      # calculate time difference from utcnow and the local system time reported by OS
-      offset = datetime.datetime.now() - datetime.datetime.utcnow()
-      return (d + offset) # Add offset to UTC time and return it
+      self.metrics[name] = self.metrics.get(name, 0) + 1
+      self.verbose("Metric {} is now {}".format(name, self.metrics[name]))
 
-   def convertTime(self,container, name):
+   def fetch(self, dev, name, url, parser, headers = None, pool = None, args = None):
       ##########################################################################################
-      # Convert received utc time string to local time string if valid
+      # Conditional GET for a device, parsed with one of the parsers. Returns the reply with
+      # the parsed data if new data was received, False when the payload is identical to the
+      # one processed last time, or None when the request failed. With a key pool, the key
+      # with the most calls left is added. In worker mode the job runs in the worker process
       ##########################################################################################
-      if name in container and container[name] is not None:
-         try:
-            dt = datetime.datetime.strptime(container[name],'%Y-%m-%dT%H:%M:%S.%fZ')
-         except:
-            return ""
-         
-         tsv = (dt - datetime.datetime(1970, 1, 1)).total_seconds()
-         d = datetime.datetime.utcfromtimestamp(tsv) # get the UTC time from the timestamp integer value.
+      cache = self.fetchCache.get(dev.id, {})
+      if cache.get('source', name) != name:
+         cache = {}    # last payload came from another source
+      hdrs = dict(headers) if headers else {}
+      if 'etag' in cache:
+         hdrs['If-None-Match'] = cache['etag']
+      if 'modified' in cache:
+         hdrs['If-Modified-Since'] = cache['modified']
+
+      params = {}
+      if pool is not None:
+         key = pool.pick()
+         if key is None:
+            self.verbose("{} has no api key with calls left today; request skipped".format(name))
+            self.countMetric("{}.noKey".format(name))
+            return None
+         if pool.header:
+            hdrs[pool.header] = key
+         else:
+            params[pool.param] = key
+
+      job = {'url' : url, 'params' : params, 'headers' : hdrs, 'parser' : parser, 'args' : args or [],
+             'hash' : cache.get('hash')}
+      self.verbose("{} device {} is requesting {}".format(name, dev.name, url))
+      if self.workerMode:
+         reply = self.worker.run(job)
+         if reply is None:
+            self.logger.warning(u"{} worker process did not answer; it will be restarted".format(name))
+            self.countMetric("{}.workerFailed".format(name))
+            if pool is not None:
+               pool.count(key)
+            return None
+      else:
+         reply = parsers.get(job)
+
+      status = reply.get('status')
+      if status is None:
+         self.verbose("{} Get ended with {}".format(name, reply.get('error')))
+         return None
+
+      if pool is not None:
+         pool.count(key)
+         if status in [401, 403, 429]:
+            self.logger.warning(u"{} api key {} refused with code {}; not used again today".format(
+                                name, pool.label(key), status))
+            pool.block(key)
+            self.countMetric("{}.keyBlocked".format(name))
+
+      if status == 304:
+         self.verbose("{} data not modified since last request".format(name))
+         self.countMetric("{}.notModified".format(name))
+         return False
 
-         # calculate time difference from utcnow and the local system time reported by OS
-         offset = datetime.datetime.now() - datetime.datetime.utcnow()
-      
-         lcl = d + offset
-         return lcl.strftime("%Y-%m-%d %H:%M")
+      if status >= 400:
+         self.verbose("{} Get ended with code {}".format(name, status))
+         self.verbose(reply.get('text'))
+         return None
+
+      if reply.get('digest') == cache.get('hash'):
+         self.verbose("{} data unchanged since last request".format(name))
+         self.countMetric("{}.unchanged".format(name))
+         return False
+
+      if reply.get('error'):
+         self.verbose("{} {}".format(name, reply['error']))
+         self.verbose(reply.get('text'))
+         return None
+
+      reply['source'] = name
+      return reply
 
-      else: 
-         return ""
+   def rememberFetch(self, dev, reply):
+      ##########################################################################################
+      # Store validators of a successfully processed response for the next conditional GET
+      ##########################################################################################
+      cache = {'hash' : reply['digest'], 'source' : reply['source']}
+      if reply.get('etag'):
+         cache['etag'] = reply['etag']
+      if reply.get('modified'):
+         cache['modified'] = reply['modified']
+      cache['fetched'] = datetime.datetime.now().isoformat()
+      self.fetchCache[dev.id] = cache
+
+   def snapshotPath(self):
+      ##########################################################################################
+      # Location of the warm restart snapshot, next to the plugin prefs
+      ##########################################################################################
+      return indigo.server.getInstallFolderPath() + "/Preferences/Plugins/" + self.pluginId + ".snapshot.json"
 
-   def handle_weerlive(self,dev):
+   def saveSnapshot(self):
+      ##########################################################################################
+      # Save schedule, fetch cache and last UV payloads so a restart can continue from here
+      ##########################################################################################
+      points = lambda pts: [[t.isoformat(), uv] for t, uv in pts]
+      snap = {'schedule'   : {name : getattr(self, name).isoformat() for name in self.SCHEDULE},
+              'fetchCache' : self.fetchCache,
+              'uvForecast' : {devId : points(pts) for devId, pts in self.uvForecast.items()},
+              'uvReadings' : {devId : points(pts) for devId, pts in self.uvReadings.items()},
+              'keyPools'   : {name : pool.state() for name, pool in self.keyPools.items()}}
+      path = self.snapshotPath()
+      try:
+         with open(path + ".tmp", "w") as f:
+            json.dump(snap, f)
+         os.replace(path + ".tmp", path)
+      except (IOError, OSError) as e:
+         self.logger.warning(u"Could not save snapshot {}: {}".format(path, e))
+
+   def restoreSnapshot(self):
+      ##########################################################################################
+      # Restore the last snapshot (if any) and stagger overdue schedule moments
+      ##########################################################################################
+      path = self.snapshotPath()
+      try:
+         with open(path) as f:
+            snap = json.load(f)
+      except (IOError, OSError, ValueError):
+         self.verbose(u"No usable snapshot {}; starting fresh".format(path))
+         snap = {}
+
+      try:
+         for name in self.SCHEDULE:
+            if name in snap.get('schedule', {}):
+               setattr(self, name, datetime.datetime.fromisoformat(snap['schedule'][name]))
+
+         points = lambda pts: [(datetime.datetime.fromisoformat(t), uv) for t, uv in pts]
+         known = lambda devId: int(devId) in indigo.devices
+         self.fetchCache = {int(devId) : cache for devId, cache in snap.get('fetchCache', {}).items() if known(devId)}
+         self.uvForecast = {int(devId) : points(pts) for devId, pts in snap.get('uvForecast', {}).items() if known(devId)}
+         self.uvReadings = {int(devId) : collections.deque(points(pts), maxlen = self.UVSLOTS)
+                            for devId, pts in snap.get('uvReadings', {}).items() if known(devId)}
+         for name, state in snap.get('keyPools', {}).items():
+            if name in self.keyPools:
+               self.keyPools[name].restore(state)
+      except (AttributeError, TypeError, ValueError) as e:
+         self.logger.warning(u"Snapshot {} could not be restored: {}".format(path, e))
+         self.fetchCache, self.uvForecast, self.uvReadings = {}, {}, {}
+
+      # Overdue providers are spread out over the next minutes instead of all at once
+      moment = datetime.datetime.now()
+      overdue = [name for name in self.SCHEDULE if getattr(self, name) <= moment]
+      for n, name in enumerate(overdue):
+         setattr(self, name, moment + n * self.STAGGER)
+      self.verbose(u"Restored snapshot; schedule {}".format(
+                   ", ".join("{} {}".format(name, getattr(self, name).strftime("%H:%M")) for name in self.SCHEDULE)))
+
+   def triggerStartProcessing(self, trigger):
+      ##########################################################################################
+      #   Start evaluating a plugin event (Events.xml) after each parse
+      ##########################################################################################
+      self.triggers[trigger.id] = trigger
+      self.triggerState[trigger.id] = False
+
+   def triggerStopProcessing(self, trigger):
+      ##########################################################################################
+      #   Stop evaluating a plugin event
+      ##########################################################################################
+      self.triggers.pop(trigger.id, None)
+      self.triggerState.pop(trigger.id, None)
+
+   def validateEventConfigUi(self, valuesDict, typeId, eventId):
+      ##########################################################################################
+      #   Validation of event configuration input given.
+      ##########################################################################################
+      errorDict = indigo.Dict()
+
+      if len(valuesDict.get("device", "")) == 0:
+         errorDict["device"] = "Select a device"
+         return (False, valuesDict, errorDict)
+
+      for field in ["minutes", "intensity", "level", "hysteresis"]:
+         if field in valuesDict and not self.isNumber(valuesDict[field]):
+            errorDict[field] = "Value should be numeric"
+            return (False, valuesDict, errorDict)
+
+      return (True, valuesDict)
+
+   def evaluateEvents(self, eventType, dev, test):
+      ##########################################################################################
+      # Evaluate the plugin events of a type for this device. test(props) returns the event
+      # condition: a true value when met, a false value when not met, and None to keep the
+      # previous state (hysteresis). An event only fires when the condition changes to a new
+      # true value, so it does not repeat on every poll
+      ##########################################################################################
+      for trigger in list(self.triggers.values()):
+         if trigger.pluginTypeId != eventType or trigger.pluginProps.get("device", "") != str(dev.id):
+            continue
+
+         try:
+            state = test(trigger.pluginProps)
+         except (KeyError, ValueError):
+            self.logger.error(u"Event {} has an invalid configuration".format(trigger.name))
+            continue
+
+         if state is None:
+            continue
+         if state and state != self.triggerState.get(trigger.id):
+            self.verbose(u"Event {} fired for device {}".format(trigger.name, dev.name))
+            indigo.trigger.execute(trigger)
+         self.triggerState[trigger.id] = state
+
+   def uvLevelTest(self, uv):
+      ##########################################################################################
+      # Return the event test for a UV index crossing a level, with a hysteresis band
+      ##########################################################################################
+      def test(props):
+         level = float(props["level"])
+         hysteresis = float(props.get("hysteresis", 0))
+         if props.get("direction", "above") == "above":
+            if uv >= level:
+               return True
+            if uv < level - hysteresis:
+               return False
+         else:
+            if uv <= level:
+               return True
+            if uv > level + hysteresis:
+               return False
+         return None
+      return test
+
+   def forecastFor(self, rec):
+      ##########################################################################################
+      # Return the UV forecast points of the uvfc device closest to this device, if any
+      ##########################################################################################
+      best = None
+      for fcId, points in self.uvForecast.items():
+         fcRec = self.registry.get(fcId)
+         if fcRec is None:
+            continue
+         dist = abs(fcRec.lat - rec.lat) + abs(fcRec.lon - rec.lon)
+         if best is None or dist < best[0]:
+            best = (dist, points)
+      return best[1] if best else []
+
+   def interpolate(self, anchors, t):
+      ##########################################################################################
+      # Linear interpolation of the UV index at time t between sorted (time, uv) anchors
+      ##########################################################################################
+      for (t0, uv0), (t1, uv1) in zip(anchors, anchors[1:]):
+         if t0 <= t <= t1:
+            span = (t1 - t0).total_seconds()
+            if span == 0:
+               return uv0
+            return uv0 + (uv1 - uv0) * (t - t0).total_seconds() / span
+      return 0.0
+
+   def uvDerivedStates(self, dev, rec, moment):
+      ##########################################################################################
+      # Build today's UV curve from the live readings and the hourly forecast, integrate the
+      # erythemal dose since sunrise and estimate the remaining safe exposure per skin type.
+      # Live readings win over forecast hours less than 30 minutes away from them. The sun
+      # rise and set moments are added with UV 0, so the curve covers the full day
+      ##########################################################################################
+      day = moment.date()
+      readings = [(t, uv) for t, uv in self.uvReadings.get(dev.id, []) if t.date() == day]
+      anchors = list(readings)
+      for t, uv in self.forecastFor(rec):
+         if t.date() == day and all(abs((t - rt).total_seconds()) > 1800 for rt, ruv in readings):
+            anchors.append((t, uv))
+
+      for state in ['sunriseEnd', 'sunsetStart']:
+         try:
+            t = datetime.datetime.strptime(dev.states[state], '%Y-%m-%d %H:%M').replace(year=day.year, month=day.month, day=day.day)
+         except (KeyError, ValueError):
+            continue
+         if not any(at == t for at, auv in anchors):
+            anchors.append((t, 0.0))
+      anchors.sort()
+      if len(anchors) < 2:
+         return []
+
+      # Fill the ring buffer with the curve in UVSTEP minute slots
+      step = datetime.timedelta(minutes = self.UVSTEP)
+      curve = self.uvCurve.setdefault(dev.id, collections.deque(maxlen = self.UVSLOTS))
+      curve.clear()
+      t = anchors[0][0]
+      while t <= anchors[-1][0]:
+         curve.append((t, self.interpolate(anchors, t)))
+         t += step
+
+      # 1 UV index is 0.025 W/m2 erythemal irradiance
+      slotDose = 0.025 * self.UVSTEP * 60
+      dose = sum(uv * slotDose for t, uv in curve if t + step <= moment)
+      ahead = [uv * slotDose for t, uv in curve if t + step > moment]
+
+      keyvalues = [{'key' : 'uvDose',    'value' : round(dose, 1), 'uiValue' : '{} J/m2'.format(round(dose, 1))},
+                   {'key' : 'uvDoseSED', 'value' : round(dose / 100.0, 2)}]
+      for x in range(1, 7):
+         budget = self.MED[x - 1] - dose
+         minutes = 0
+         if budget > 0:
+            minutes = -1
+            for n, slot in enumerate(ahead):
+               if slot >= budget:
+                  minutes = int(round((n + budget / slot) * self.UVSTEP))
+                  break
+               budget -= slot
+         keyvalues.append({'key' : 'safeLeft_st{}'.format(x), 'value' : minutes,
+                           'uiValue' : 'no limit today' if minutes < 0 else '{} minutes'.format(minutes)})
+      self.verbose("UVactual dose today {} J/m2 from {} curve points".format(round(dose, 1), len(curve)))
+      return keyvalues
+
+   def fetchWeerlive(self, dev, rec):
+      ##########################################################################################
+      # Fetch the weerlive states from the best healthy provider, falling over to the next
+      # one when it fails. Returns like fetch()
+      ##########################################################################################
+      moment = datetime.datetime.now()
+      providers = self.weerliveProviders if self.weerliveFailover else self.weerliveProviders[0:1]
+      ranked = sorted([p for p in providers if p.healthy(moment)], key = lambda p: p.rank())
+      if len(ranked) == 0:
+         self.verbose("Weerlive has no healthy source; next attempt at {}".format(
+                      min(p.downUntil for p in providers).strftime("%H:%M")))
+         return None
+
+      for provider in ranked:
+         pool = self.keyPools[provider.pool] if provider.pool else None
+         if pool is not None and pool.pick() is None:
+            # no key with calls left today; leave this provider out until tomorrow
+            provider.downUntil = datetime.datetime.combine(moment.date() + datetime.timedelta(days = 1),
+                                                           datetime.time())
+            self.verbose("{} has no api key with calls left today".format(provider.name))
+            continue
+
+         start = time.time()
+         reply = self.fetch(dev, provider.name, provider.url or rec.url, provider.parser, pool = pool,
+                            args = [rec.lat, rec.lon] if provider.located else None)
+         if reply is None:
+            provider.failure(moment)
+            self.countMetric("{}.failed".format(provider.name))
+            continue
+
+         provider.success(time.time() - start)
+         if provider is not providers[0]:
+            self.countMetric("{}.failover".format(provider.name))
+         if not reply:
+            return reply    # unchanged since the last poll; nothing to apply
+         if dev.states.get("dataSource", "") not in ["", provider.name]:
+            self.logger.info(u"Weerlive device {} is now using {}".format(dev.name, provider.name))
+         reply['clears'] = provider.clears
+         return reply
+      return None
+
+   def handle_weerlive(self,dev,rec):
       ##########################################################################################
       # Get the lastest Weather information from Weerlive
       ##########################################################################################
@@ -284,68 +930,55 @@ class Plugin(indigo.PluginBase):
       # Set Next Run Moment
       # -------------------
 
-      self.nxtWeerlive = datetime.datetime.now() + \
-                               datetime.timedelta(minutes = int(self.pluginPrefs["WeerLiveInterval"]))
+      self.nxtWeerlive = datetime.datetime.now() + rec.interval
       self.verbose("Start Weerlive action now. Scheduled next run at {}".format(self.nxtWeerlive))
-      dev.updateStateOnServer(key = "nextPlannedUpdate", 
-                              value = self.nxtWeerlive.strftime("%Y-%m-%d %H:%M"))
 
       # -------------------
       # Request data
       # -------------------
 
-      data = "{}?key={}&locatie={},{}".format(self.urlWL
-                                             ,self.pluginPrefs["ApiKey"]
-                                             ,dev.ownerProps["lat"]
-                                             ,dev.ownerProps["lon"])
-      self.verbose("Weerlive device {} is requesting {}".format(dev.name, data))
-
-      try:
-         r = requests.get(url = data, timeout=30, verify=False)
-      except requests.exceptions.RequestException as e:
-        if code in e:
-           self.verbose("Weerlive Get ended with {}".format(e.code))
-        else:
-           raise e
-        return  
-           
-      if not r.ok:
-         self.verbose("Weerlive Get ended with code {}".format(r.status_code))
+      reply = self.fetchWeerlive(dev, rec)
+      if reply is None:
+         dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtWeerlive.strftime("%Y-%m-%d %H:%M"))
+      if not reply:
          return
 
       # -------------------
       # Parse result
       # -------------------
 
-      try:
-         rj = r.json()
-      except:
-         self.verbose("Weerlive could not decode the response into JSON")
-         self.verbose(r.text)
-         return
-
       # add the resulting json info to our states
-      if "liveweer" in rj:
-         for m in rj['liveweer']:
-            for key in m:
-               if key in dev.states:
-                  if type(dev.states[key]) is str:
-                     dev.updateStateOnServer(key = key, value = m[key])
-                  else:
-                     dev.updateStateOnServer(key = key, value = m[key] * 1)
+      for m in reply['data']:
+         for key in m:
+            if key in dev.states:
+               if type(dev.states[key]) is str:
+                  dev.updateStateOnServer(key = key, value = m[key])
                else:
-                  self.verbose('Key {} (value {}) received but not present in device config; ignored'.format(key,m[key]))
-
-               # reset alarm txt if no longer present
-               if 'alarm' in m and m['alarm'] == '0':
-                  dev.updateStateOnServer(key = 'alarmtxt', value = '')
-      else:
-         self.verbose("Weerlive result did not contain the expected 'weerlive' info")
-         return
+                  dev.updateStateOnServer(key = key, value = m[key] * 1)
+            else:
+               self.verbose('Key {} (value {}) received but not present in device config; ignored'.format(key,m[key]))
+
+            # reset alarm txt if no longer present
+            if 'alarm' in m and m['alarm'] == '0':
+               dev.updateStateOnServer(key = 'alarmtxt', value = '')
+
+         if 'alarm' in m:
+            alarmtxt = m.get('alarmtxt', '') if str(m['alarm']) != '0' else ''
+            self.evaluateEvents("weatherAlarm", dev, lambda props: alarmtxt)
+
+      # States the provider has no data for; only written when not cleared already
+      cleared = []
+      for key in reply.get('clears', []):
+         if key in dev.states:
+            value = '' if type(dev.states[key]) is str else 0
+            if dev.states[key] != value:
+               cleared.append({'key' : key, 'value' : value})
+      if cleared:
+         dev.updateStatesOnServer(cleared)
 
       # Update day of week
       moment = datetime.datetime.now()
-      dow = self.pluginPrefs["DaysOfWeek"].split(',')
+      dow = self.daysOfWeek
 
       dev.updateStateOnServer(key = "d0day", value = dow[moment.weekday()])
       moment = moment + datetime.timedelta(hours = 24)
@@ -357,13 +990,15 @@ class Plugin(indigo.PluginBase):
       # Update and finish
       # -------------------
       
-      dev.updateStateOnServer(key = "lastSuccessfullRun", 
-                              value = datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
+      dev.updateStatesOnServer([{'key' : 'dataSource',         'value' : reply['source']},
+                                {'key' : 'nextPlannedUpdate',  'value' : self.nxtWeerlive.strftime("%Y-%m-%d %H:%M")},
+                                {'key' : 'lastSuccessfullRun', 'value' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M")}])
+      self.rememberFetch(dev, reply)
       self.verbose("Weerlive finished. Updated device")
       return
 
 
-   def handle_buienradar(self,dev):
+   def handle_buienradar(self,dev,rec):
       ##########################################################################################
       # Get the lastest Weather information from Buienradar
       ##########################################################################################
@@ -373,89 +1008,37 @@ class Plugin(indigo.PluginBase):
       # -------------------
 
       moment = datetime.datetime.now()
-      self.nxtBuienradar = moment + datetime.timedelta(minutes = int(self.pluginPrefs["BuienRadarInterval"]))
+      self.nxtBuienradar = moment + rec.interval
       self.verbose("Start BuienRadar action now. Scheduled next run at {}".format(self.nxtBuienradar))
-      dev.updateStateOnServer(key = "nextPlannedUpdate", 
-                              value = self.nxtBuienradar.strftime("%Y-%m-%d %H:%M"))
 
       # -------------------
       # Request data
       # -------------------
 
-      data = "{}?lat={}&lon={}".format(self.urlRT
-                                      ,dev.ownerProps["lat"]
-                                      ,dev.ownerProps["lon"])
-      self.verbose("BuienRadar device {} is requesting {}".format(dev.name, data))
-
-      try:
-         r = requests.get(url = data, timeout=30,verify=False)
-      except requests.exceptions.RequestException as e:
-         self.verbose("BuienRadar Get ended with {}".format(e.code))
-         return
-
-      if not r.ok:
-         self.verbose("BuienRadar Get ended with code {}".format(r.status_code))
+      reply = self.fetch(dev, "BuienRadar", rec.url, "raintext")
+      if reply is None:
+         dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtBuienradar.strftime("%Y-%m-%d %H:%M"))
+      if not reply:
          return
 
       # -------------------
       # Parse result
       # -------------------
 
-      # The rain next 10 minutes is 2 iterations, next hour is 12, next 2 hours is all
-      sum10  = 0.0
-      sum60  = 0.0
-      sum120 = 0.0 
-      fstr = ""
-      raintext = ""
-
-      hr = moment.hour
-      hrBefore = moment.hour
-      minBefore = moment.minute
-
-      itercount = 0
-      rlines = ""
-
-
-      for l in r.text.splitlines():
-         rlines = rlines + l + ","
-         itercount += 1
-         rainfall , raintime  = l.split("|")
-         raintime = raintime.strip()
-         rainfall = rainfall.strip()
-         raintext += rainfall + ";" 
-
-         if len(raintime) > 4 and raintime[0:2].isnumeric() and raintime[3:].isnumeric():
-            hrBefore = int(raintime[0:2])
-            minBefore = int(raintime[3:])
-
-            if hrBefore < hr:
-               # day change
-               moment = moment + datetime.timedelta(days=1)
-         nt = moment.replace(hour=hrBefore, minute=minBefore)
-         hr = hrBefore
-         
-         # Thanks to https://github.com/mjj4791/python-buienradar/pull/13
-         intensiteit = (10 ** ((float(rainfall.replace(',', '.')) - 109.0) / 32.0)) / 12.0 # Divide by 12 since it is a 5 minute period 
-
-         # Add to running total
-         if itercount < 3:
-            sum10 += intensiteit
-         if itercount < 13:
-            sum60 += intensiteit
-         sum120 += intensiteit 
-         
-         
-         # And to plot input file in memory
-         fstr += "{},{}\n".format(nt,str(round(intensiteit,2)))
-
-      sum10 = round(sum10,3)
-      sum60 = round(sum60,3)
-      sum120 = round(sum120,3)
+      rain = reply['data']
+      sum10 = rain['sum10']
+      sum60 = rain['sum60']
+      sum120 = rain['sum120']
+      fstr = rain['csv']
       self.verbose("10:{}, 60:{}, 120;{}".format(sum10,sum60,sum120))
+
+      self.evaluateEvents("rainExpected", dev,
+                          lambda props: any(ahead <= float(props["minutes"]) and mmhr > float(props["intensity"])
+                                            for ahead, mmhr in rain['forecast']))
       dev.updateStatesOnServer([{'key' : 'rain010Minutes',  'value' : sum10, 'uiValue':"{} mm / 10 mn".format(sum10), 'decimalPlaces':2},
                                 {'key' : 'rain060Minutes',  'value' : sum60, 'uiValue':"{} mm / hr".format(sum60), 'decimalPlaces':2},
                                 {'key' : 'rain120Minutes',  'value' : sum120,'uiValue':"{} mm / 2 hr".format(sum120), 'decimalPlaces':2},
-                                {'key' : 'rainText',        'value' : raintext}])
+                                {'key' : 'rainText',        'value' : rain['raintext']}])
 
       # 25 mm / uur is hoosbui
 
@@ -466,7 +1049,7 @@ class Plugin(indigo.PluginBase):
 
       # if MATPLOTLIB is installed AND checked will serve a picture as well
       mpl = indigo.server.getPlugin(self.mplid)
-      if "PlotMode" in self.pluginPrefs and self.pluginPrefs["PlotMode"] and mpl.isEnabled():
+      if self.plotMode and mpl.isEnabled():
 
          self.verbose("BuienRadar found MatplotLib")
          # Check if we can open its plugin prefs file
@@ -502,11 +1085,13 @@ class Plugin(indigo.PluginBase):
       # Update and finish
       # -------------------
       
-      dev.updateStateOnServer(key = "lastSuccessfullRun",value = datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
+      dev.updateStatesOnServer([{'key' : 'nextPlannedUpdate',  'value' : self.nxtBuienradar.strftime("%Y-%m-%d %H:%M")},
+                                {'key' : 'lastSuccessfullRun', 'value' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M")}])
+      self.rememberFetch(dev, reply)
       self.verbose("BuienRadar finished. Updated device")
       return
 
-   def handle_uvactual(self,dev):
+   def handle_uvactual(self,dev,rec):
       ##########################################################################################
       # Get current UV index from openuv.io
       ##########################################################################################
@@ -524,7 +1109,7 @@ class Plugin(indigo.PluginBase):
       except:
          # date is not usable
          date_usable = False
-         si = 30 # set default minutes
+         si = rec.interval
 
       # -------------------
       # Check for daylight
@@ -544,60 +1129,41 @@ class Plugin(indigo.PluginBase):
                moment = moment.replace(hour=sunriseEnd.hour, minute=sunriseEnd.minute)
 
          sunUpDuration = sunsetStart_hhmm - sunriseEnd_hhmm # minutes sun is up
-         si = int(round(float(sunUpDuration) / (float(self.pluginPrefs['UVindexDailyMax']) - 1),0))
+         si = datetime.timedelta(minutes = int(round(float(sunUpDuration) / (float(self.keyPools['openuv'].capacity()) - 1),0)))
       
 
-      self.nxtUV = moment + datetime.timedelta(minutes = si)
+      self.nxtUV = moment + si
       self.verbose("Start UVactual action now. Scheduled next run at {}".format(self.nxtUV))
-      
-      dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtUV.strftime("%Y-%m-%d %H:%M"))
 
       # -------------------
       # Request data
       # -------------------
 
-      data = "{}?lat={}&lng={}".format(self.urlUV,dev.ownerProps["lat"], dev.ownerProps["lon"])
-      headers = {'content-type' : 'application/json',
-                'x-access-token': self.pluginPrefs["UVApiKey"]
-                }
-
-      self.verbose("UVactual device {} is requesting {}".format(dev.name, data))
-      try: 
-         r = requests.get(url = data, headers = headers,timeout=30,verify=False)
-      except requests.exceptions.RequestException as e:
-         self.verbose("UVactual Get ended with {}".format(e.code))
+      reply = self.fetch(dev, "UVactual", rec.url, "openuv", rec.headers, self.keyPools['openuv'])
+      if reply is None:
+         dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtUV.strftime("%Y-%m-%d %H:%M"))
+      if not reply:
          return
 
-      if not r.ok:
-         self.verbose("UVactual Get ended with code {}".format(r.status_code))
-         self.verbose(r.text)
-         return
- 
-
       # -------------------
       # Parse result
       # -------------------
 
-      try:
-         rj = r.json()
-      except:
-         self.verbose("UVactual could not decode the response into JSON")
-         self.verbose(r.text)
-         return
-
-      # result is expeced in the answer
-      if not 'result' in rj:
-         self.verbose("UVactual result did not contain the expected 'result' info")
-         return
-      res = rj['result']
+      uv = reply['data']
 
       keyvalues = []
-      if 'uv_time' in res and 'uv' in res:
-         lcl = self.utcToLocal(res['uv_time'])
-         keyvalues.append({'key' : 'uvtime', 'value'  : self.convertTime(res, 'uvtime')})
-         keyvalues.append({'key' : 'uvindex', 'value' : round(float(res['uv']), 2)})
-
-         intuv = int(math.floor(float(res['uv'])))
+      if 'uv' in uv:
+         lcl = datetime.datetime.fromisoformat(uv['time'])
+         keyvalues.append({'key' : 'uvtime', 'value'  : lcl.strftime("%Y-%m-%d %H:%M")})
+         keyvalues.append({'key' : 'uvindex', 'value' : round(uv['uv'], 2)})
+
+         # Keep today's live readings for the derived UV curve
+         readings = self.uvReadings.setdefault(dev.id, collections.deque(maxlen = self.UVSLOTS))
+         while readings and readings[0][0].date() != lcl.date():
+            readings.popleft()
+         readings.append((lcl, uv['uv']))
+
+         intuv = int(math.floor(uv['uv']))
          keyvalues.append({'key' : 'uvint', 'value' : intuv})
          if intuv > 10:
             uvname = 'Extreme'
@@ -607,41 +1173,34 @@ class Plugin(indigo.PluginBase):
                      ,'High','High'                                 #6-8
                      ,'Very High','Very High','Very High'][intuv]   #8-11
          keyvalues.append({'key' : 'uvname', 'value' : uvname})
+         self.evaluateEvents("uvLevel", dev, self.uvLevelTest(uv['uv']))
 
-      if 'uvmax' in res:
-         keyvalues.append({'key' : 'uvmax', 'value'  : round(float(res['uv_max']), 2)})
+      if 'uvmax' in uv:
+         keyvalues.append({'key' : 'uvmax', 'value'  : uv['uvmax']})
        
-      if 'ozone' in res and 'ozone_time' in res:
-         keyvalues.append({'key' : 'ozone', 'value' : res['ozone']})
-         keyvalues.append({'key' :  'ozonetime', 'value' : self.convertTime(res, 'ozonetime')})
+      if 'ozone' in uv:
+         keyvalues.append({'key' : 'ozone', 'value' : uv['ozone']})
+         keyvalues.append({'key' :  'ozonetime', 'value' : uv['ozonetime']})
 
-      if 'safe_exposure_time' in res: 
-         se = res['safe_exposure_time']
-         for x in range(1,7):
-           if 'st{}'.format(x) in se:
-              keyvalues.append({'key' : 'safe_st{}'.format(x), 'value' : se['st{}'.format(x)], 
-                                'uiValue': '{} minutes'.format(se['st{}'.format(x)])})
+      for st, minutes in sorted(uv['safe'].items()):
+         keyvalues.append({'key' : 'safe_{}'.format(st), 'value' : minutes, 'uiValue': '{} minutes'.format(minutes)})
 
-      if 'sun_info' in res:
-         si = res['sun_info']
-         if 'sun_times' in si:
-            st = si['sun_times']
-
-            keyvalues.append({'key' : 'sunriseEnd',  'value' : self.convertTime(st, 'sunriseEnd')})
-            keyvalues.append({'key' : 'sunsetStart', 'value' : self.convertTime(st, 'sunsetStart')})
-            keyvalues.append({'key' : 'solarNoon',   'value' : self.convertTime(st, 'solarNoon')})
-            keyvalues.append({'key' : 'night',       'value' : self.convertTime(st, 'night') } )
+      for name, value in sorted(uv.get('sun', {}).items()):
+         keyvalues.append({'key' : name, 'value' : value})
 
       # -------------------
       # Update and finish
       # -------------------
       
+      keyvalues.extend(self.uvDerivedStates(dev, rec, datetime.datetime.now()))
+      keyvalues.append({'key' : 'nextPlannedUpdate', 'value' : self.nxtUV.strftime("%Y-%m-%d %H:%M")})
       keyvalues.append({'key' : 'lastSuccessfullRun', 'value' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M")})
       dev.updateStatesOnServer(keyvalues)
+      self.rememberFetch(dev, reply)
       self.verbose("UVactual finished. Updated device")
 
 
-   def handle_uvforecast(self,dev):
+   def handle_uvforecast(self,dev,rec):
       ##########################################################################################
       # This function will retrieve forecast info from OpenUV.io
       #
@@ -661,71 +1220,52 @@ class Plugin(indigo.PluginBase):
       self.nxtuvforecast = moment + datetime.timedelta(days = 1)
       self.nxtuvforecast = self.nxtuvforecast.replace(hour=nexthr, minute=nextmi, second=0)
       self.verbose("Start UVforecast action now. Scheduled next run at {}".format(self.nxtuvforecast))
-      dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtuvforecast.strftime("%Y-%m-%d %H:%M"))
 
       # -------------------
       # Request data
       # -------------------
 
-      data = "{}?lat={}&lng={}".format(self.urlUVfc,dev.ownerProps["fclat"], dev.ownerProps["fclon"])
-      headers = {'content-type' : 'application/json',
-                'x-access-token': self.pluginPrefs["UVApiKey"]
-                }
-
-      self.verbose("UVforecast device {} is requesting {}".format(dev.name, data))
-      try: 
-         r = requests.get(url = data, headers = headers,timeout=30,verify=False)
-      except requests.exceptions.RequestException as e:
-         self.verbose("UVforecast Get ended with {}".format(e.code))
+      reply = self.fetch(dev, "UVforecast", rec.url, "openuvforecast", rec.headers, self.keyPools['openuv'])
+      if reply is None:
+         dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtuvforecast.strftime("%Y-%m-%d %H:%M"))
+      if not reply:
          return
 
-      if not r.ok:
-         self.verbose("UVforecast Get ended with code {}".format(r.status_code))
-         self.verbose(r.text)
-         return
- 
       # -------------------
       # Parse result
       # -------------------
 
-      try:
-         rj = r.json()
-      except:
-         self.verbose("UVforecast could not decode the response into JSON")
-         self.verbose(r.text)
-         return
-
-      # result is expeced in the answer
-      if not 'result' in rj:
-         self.verbose("UVforecast result did not contain the expected 'result' info")
-         return
-      res = rj['result']
+      points = [(datetime.datetime.fromisoformat(t), uv) for t, uv in reply['data']]
 
       keyvalues = []
-      # note time in utc
       maxuv = 0
       maxhr = 0
-      for r in res:
-         lcl = self.utcToLocal(r['uv_time'])
-         thisuv = round(float(r['uv']),2)
+      maxday = None
+      for lcl, thisuv in points:
          if thisuv > maxuv:
             maxuv = thisuv
             maxhr = lcl.hour
+            maxday = lcl.date().isoformat()
          keyvalues.append({'key' : 'UVForeCastHour_{0:02d}'.format(lcl.hour) ,'value' : thisuv})
 
       keyvalues.append({'key' : 'MaxExpected', 'value' : maxuv})
       keyvalues.append({'key' : 'MaxHour', 'value' : maxhr})   
+      # the forecast day is the event state, so it fires once for every day above the level
+      self.evaluateEvents("uvForecastLevel", dev, lambda props: maxday if maxuv >= float(props["level"]) else False)
+      self.uvForecast[dev.id] = points
 
       # -------------------
       # Update and finish
       # -------------------
       
+      keyvalues.append({'key' : 'nextPlannedUpdate', 'value' : self.nxtuvforecast.strftime("%Y-%m-%d %H:%M")})
       keyvalues.append({'key' : 'lastSuccessfullRun', 'value' : datetime.datetime.now().strftime("%Y-%m-%d %H:%M")})
       dev.updateStatesOnServer(keyvalues)
+      self.rememberFetch(dev, reply)
       self.verbose("UVforecast finished. Updated device")
 
 
-   def handle_moonphase(self,dev):  
+   def handle_moonphase(self,dev,rec):  
       ##########################################################################################
       # Calculate moonphase
       ##########################################################################################
@@ -737,7 +1277,7 @@ class Plugin(indigo.PluginBase):
       now = datetime.datetime.now() # Get current time
 
       # Set next run time
-      self.nxtMoon = now + datetime.timedelta(minutes = 60)
+      self.nxtMoon = now + rec.interval
       self.verbose("Start Moonphase action now. Scheduled next run at {}".format(self.nxtMoon))
       dev.updateStateOnServer(key = "nextPlannedUpdate", value = self.nxtMoon.strftime("%Y-%m-%d %H:%M"))
     
@@ -756,7 +1296,7 @@ class Plugin(indigo.PluginBase):
       moonId = int(index) & 7
 
       # get moonphase and image description
-      mylang = self.pluginPrefs.get("MoonLanguage","NL")
+      mylang = self.moonLanguage
 
       # -------------------
       # Update and finish
@@ -781,44 +1321,45 @@ class Plugin(indigo.PluginBase):
       try:
          while True: #  Until we are requested to stop
 
+            self.stopRetiredWorkers()
             moment = datetime.datetime.now()
-            # Get a list of all defined devices for this plugin
-            for dev in indigo.devices.iter("self"):
+            schedule = [getattr(self, name) for name in self.SCHEDULE]
+            # Walk the registry of started (enabled) devices for this plugin
+            for rec in list(self.registry.values()):
 
                # Check if we want to retrieve information for this type
-               if (dev.deviceTypeId == "weerlive" and 
-                  dev.enabled and
+               if (rec.typeId == "weerlive" and 
                   moment >= self.nxtWeerlive and
-                  self.pluginPrefs["WeerLiveMode"]):
-                  self.handle_weerlive(dev)
+                  self.weerliveMode):
+                  self.handle_weerlive(indigo.devices[rec.devId], rec)
 
                # Check if we want to retrieve information for this type
-               if (dev.deviceTypeId == "buienradar" and 
-                  dev.enabled and 
+               if (rec.typeId == "buienradar" and 
                   moment >=self.nxtBuienradar and
-                  self.pluginPrefs["BuienradarMode"]):
-                  self.handle_buienradar(dev)
+                  self.buienradarMode):
+                  self.handle_buienradar(indigo.devices[rec.devId], rec)
 
                # Check if we want to retrieve information for this type
-               if (dev.deviceTypeId == "uv" and 
-                  dev.enabled and 
+               if (rec.typeId == "uv" and 
                   moment >= self.nxtUV and
-                  self.pluginPrefs["UVindexMode"]):
-                  self.handle_uvactual(dev)
+                  self.uvMode):
+                  self.handle_uvactual(indigo.devices[rec.devId], rec)
 
               # Check if we want to retrieve information for this type
-               if (dev.deviceTypeId == "uvfc" and 
-                  dev.enabled and 
+               if (rec.typeId == "uvfc" and 
                   moment >= self.nxtuvforecast and
-                  self.pluginPrefs["uvforecastMode"]):
-                  self.handle_uvforecast(dev)   
+                  self.uvforecastMode):
+                  self.handle_uvforecast(indigo.devices[rec.devId], rec)   
 
                # Check if we want to retrieve information for this type
-               if (dev.deviceTypeId == "moon" and 
-                  dev.enabled and 
+               if (rec.typeId == "moon" and 
                   moment >= self.nxtMoon and
-                  self.pluginPrefs["MoonPhaseMode"]):
-                  self.handle_moonphase(dev)   
+                  self.moonMode):
+                  self.handle_moonphase(indigo.devices[rec.devId], rec)   
+
+            # Save the snapshot whenever something ran
+            if schedule != [getattr(self, name) for name in self.SCHEDULE]:
+               self.saveSnapshot()
 
             self.sleep(60)
 
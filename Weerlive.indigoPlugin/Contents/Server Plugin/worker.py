@@ -0,0 +1,126 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+##########################################################################################
+#
+#   Worker process for the Weerlive plugin. When worker mode is enabled, all requests and
+#   parsing run in this child process so an exception or memory growth there cannot take
+#   the plugin down. Jobs and replies are single json lines over stdin / stdout.
+#
+#   The plugin side uses the Worker class below; the child runs main()
+#
+#########################################################################################
+
+import json
+import os
+import resource
+import select
+import subprocess
+import sys
+
+
+class Worker(object):
+##########################################################################################
+#   Plugin side of the worker: starts the child, sends jobs and waits for the replies.
+#   The child is recycled after maxJobs jobs and killed when it does not answer in time
+##########################################################################################
+
+   def __init__(self, python, maxJobs, maxMemory, timeout = 60):
+      self.python    = python
+      self.maxJobs   = maxJobs
+      self.maxMemory = maxMemory      # MB
+      self.timeout   = timeout        # seconds; requests themselves time out after 30
+      self.proc      = None
+      self.jobs      = 0
+
+   def start(self):
+      self.proc = subprocess.Popen([self.python, os.path.abspath(__file__), str(self.maxMemory)],
+                                   stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                   universal_newlines = True, bufsize = 1)
+      self.jobs = 0
+
+   def stop(self):
+      if self.proc is None:
+         return
+      try:
+         self.proc.stdin.close()
+         self.proc.wait(5)
+      except (OSError, subprocess.TimeoutExpired):
+         self.proc.kill()
+         self.proc.wait()
+      self.proc = None
+
+   def kill(self):
+      if self.proc is not None:
+         self.proc.kill()
+         self.proc.wait()
+         self.proc = None
+
+   def run(self, job):
+      ##########################################################################################
+      # Run one job in the child. Returns the reply, or None if the child died or hung
+      ##########################################################################################
+      if self.proc is not None and (self.proc.poll() is not None or self.jobs >= self.maxJobs):
+         self.stop()
+      if self.proc is None:
+         self.start()
+
+      try:
+         self.proc.stdin.write(json.dumps(job) + "\n")
+         self.proc.stdin.flush()
+      except (OSError, ValueError):
+         self.kill()
+         return None
+
+      if not select.select([self.proc.stdout], [], [], self.timeout)[0]:
+         self.kill()
+         return None
+
+      line = self.proc.stdout.readline()
+      if not line:
+         # child exited, e.g. because it reached its memory ceiling
+         self.kill()
+         return None
+      self.jobs += 1
+      try:
+         return json.loads(line)
+      except ValueError:
+         # garbled reply, e.g. the child wrote something else to stdout
+         self.kill()
+         return None
+
+
+def memoryUsed():
+   ##########################################################################################
+   # Peak memory of this process in MB (ru_maxrss is in bytes on macOS, KB on Linux)
+   ##########################################################################################
+   rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+   return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def main():
+   ##########################################################################################
+   # Child process: answer jobs until stdin closes or the memory ceiling is reached
+   ##########################################################################################
+   import parsers
+
+   maxMemory = int(sys.argv[1])
+   try:
+      limit = maxMemory * 1024 * 1024 * 2    # hard stop well above the soft ceiling
+      resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+   except (ValueError, OSError):
+      pass    # not supported on every platform; the check below still applies
+
+   for line in sys.stdin:
+      try:
+         reply = parsers.get(json.loads(line))
+      except Exception as e:
+         reply = {'status' : None, 'error' : "worker failed: {}".format(e)}
+      sys.stdout.write(json.dumps(reply) + "\n")
+      sys.stdout.flush()
+
+      if memoryUsed() > maxMemory:
+         break
+
+
+if __name__ == "__main__":
+   main()